@@ -435,6 +435,8 @@ def get_basemap_data(filepath):
     return bottle.static_file(filepath, root="./data/basemaps/")
 
 def get_zone_data(filepath):
+    if filepath.endswith(".cache.pkl"): # the shape layer caches from Datasets.py live next to the zone files, don't serve them
+        return bottle.HTTPError(404, "File does not exist.")
     return bottle.static_file(filepath, root="./data/zones/")
 
 def get_downloads(filepath):
@@ -457,10 +459,15 @@ def main():
     parser.add_argument("-v", "--verbose", action="store_true", help="Enable verbose debugging", default=False)
     parser.add_argument("--host", action="store", dest="host", type=str, help="Host to bind to", default="0.0.0.0")
     parser.add_argument("--port", action="store", dest="port", type=int, help="Port to listen on", default=8080)
+    parser.add_argument("--preload_datasets", action="store_true", help="Load all of the datasets on startup instead of when they are first used", default=False)
 
 
     args = parser.parse_args(sys.argv[1:])
 
+    # This has to happen before we start any threads (e.g. the session monitor below) as `load_all` loads the shape files in a process pool
+    if args.preload_datasets:
+        DATASETS.load_all()
+
     # Create session factory to handle incoming requests
     SESSION_HANDLER = SessionHandler(args)
     SESSION_HANDLER.start_monitor(SESSION_TIMEOUT_SECONDS)
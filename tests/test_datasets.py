@@ -0,0 +1,281 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import json
+import pickle
+
+import numpy as np
+
+from web_tool import Datasets
+from web_tool.DataLoader import DataLoaderCustom, get_shape_by_extent_from_shape_layer
+
+
+def write_geojson(fn, boxes):
+    features = []
+    for i, (minx, miny, maxx, maxy) in enumerate(boxes):
+        features.append({
+            "type": "Feature",
+            "properties": {"id": i},
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": [[[minx, miny], [maxx, miny], [maxx, maxy], [minx, maxy], [minx, miny]]]
+            }
+        })
+    with open(fn, "w") as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f)
+
+
+def test_shape_cache_is_written_and_reused(tmp_path):
+    fn = str(tmp_path / "zones.geojson")
+    write_geojson(fn, [(106.0, 10.0, 106.1, 10.1)])
+
+    shapes, areas, crs = Datasets._load_geojson_as_list(fn)
+    assert os.path.exists(fn + ".cache.pkl")
+    assert len(shapes) == 1
+    assert areas.dtype == np.float64
+    assert 100 < areas[0] < 130 # a 0.1 x 0.1 degree box at 10 degrees north is ~120 km^2
+
+    # Make the cache distinguishable from the geojson, if it is reused we should get the cached areas back
+    with open(fn + ".cache.pkl", "rb") as f:
+        cache_version, shapes_wkb, _, src_crs = pickle.load(f)
+    with open(fn + ".cache.pkl", "wb") as f:
+        pickle.dump((cache_version, shapes_wkb, np.array([-1.0]), src_crs), f)
+
+    _, areas, _ = Datasets._load_geojson_as_list(fn)
+    assert areas[0] == -1.0
+
+
+def test_shape_cache_is_invalidated_by_newer_geojson(tmp_path):
+    fn = str(tmp_path / "zones.geojson")
+    write_geojson(fn, [(106.0, 10.0, 106.1, 10.1)])
+    Datasets._load_geojson_as_list(fn)
+
+    write_geojson(fn, [(106.0, 10.0, 106.1, 10.1), (106.1, 10.0, 106.2, 10.1)])
+    cache_mtime = os.path.getmtime(fn + ".cache.pkl")
+    os.utime(fn, (cache_mtime + 10, cache_mtime + 10))
+
+    shapes, areas, _ = Datasets._load_geojson_as_list(fn)
+    assert len(shapes) == 2
+    assert len(areas) == 2
+
+
+def test_shape_cache_is_invalidated_by_old_version(tmp_path):
+    fn = str(tmp_path / "zones.geojson")
+    write_geojson(fn, [(106.0, 10.0, 106.1, 10.1)])
+    with open(fn + ".cache.pkl", "wb") as f:
+        pickle.dump((Datasets.SHAPE_CACHE_VERSION - 1, [], [], "EPSG:4326"), f)
+
+    shapes, areas, _ = Datasets._load_geojson_as_list(fn)
+    assert len(shapes) == 1
+    with open(fn + ".cache.pkl", "rb") as f:
+        assert pickle.load(f)[0] == Datasets.SHAPE_CACHE_VERSION
+
+
+def test_shape_cache_fills_in_missing_areas(tmp_path):
+    fn = str(tmp_path / "zones.geojson")
+    write_geojson(fn, [(106.0, 10.0, 106.1, 10.1)])
+
+    _, areas, _ = Datasets._load_geojson_as_list(fn, compute_areas=False)
+    assert np.isnan(areas[0])
+    with open(fn + ".cache.pkl", "rb") as f:
+        assert pickle.load(f)[2] is None
+
+    _, areas, _ = Datasets._load_geojson_as_list(fn, compute_areas=True)
+    assert not np.isnan(areas[0])
+    with open(fn + ".cache.pkl", "rb") as f:
+        assert pickle.load(f)[2] is not None
+
+
+def make_dataset(shapes_fn, data_path=None):
+    return {
+        "dataLayer": {"type": "CUSTOM", "path": data_path, "padding": 0} if data_path is not None else {"type": "BASEMAP", "path": "http://localhost/{z}/{x}/{y}.png", "padding": 0},
+        "shapeLayers": [{"shapesFn": shapes_fn, "zoneNameKey": "id", "name": "Zones"}]
+    }
+
+
+def test_registry_loads_datasets_lazily(tmp_path):
+    fn = str(tmp_path / "zones.geojson")
+    write_geojson(fn, [(106.0, 10.0, 106.1, 10.1)])
+    datasets = Datasets._DatasetRegistry({"test": make_dataset(fn)})
+
+    assert not os.path.exists(fn + ".cache.pkl")
+    assert "test" in datasets
+    assert len(datasets["test"]["shape_layers"]["Zones"]["geoms"]) == 1
+    assert "not_a_dataset" not in datasets
+
+
+def test_registry_skips_datasets_with_missing_files(tmp_path):
+    fn = str(tmp_path / "zones.geojson")
+    write_geojson(fn, [(106.0, 10.0, 106.1, 10.1)])
+    datasets = Datasets._DatasetRegistry({
+        "missing_shapes": make_dataset(str(tmp_path / "missing.geojson")),
+        "missing_data": make_dataset(fn, str(tmp_path / "missing.tif")),
+    })
+
+    assert "missing_shapes" not in datasets
+    assert "missing_data" not in datasets
+    try:
+        datasets["missing_data"]
+        assert False, "expected a KeyError"
+    except KeyError:
+        pass
+    assert not os.path.exists(fn + ".cache.pkl") # we shouldn't load any shapes for a dataset that can't be served
+
+
+def test_get_shape_by_extent_uses_the_shape_layer_index(tmp_path):
+    fn = str(tmp_path / "zones.geojson")
+    write_geojson(fn, [(106.0, 10.0, 106.1, 10.1), (106.1, 10.0, 106.2, 10.1)])
+    datasets = Datasets._DatasetRegistry({"test": make_dataset(fn)})
+    shape_layer = datasets["test"]["shape_layers"]["Zones"]
+
+    extent = {"xmin": 106.14, "xmax": 106.16, "ymin": 10.04, "ymax": 10.06, "crs": "epsg:4326"}
+    i, shape = get_shape_by_extent_from_shape_layer(extent, shape_layer)
+    assert i == 1
+    assert shape.equals(shape_layer["geoms"][1])
+
+    extent = {"xmin": 107.0, "xmax": 107.1, "ymin": 10.04, "ymax": 10.06, "crs": "epsg:4326"}
+    try:
+        get_shape_by_extent_from_shape_layer(extent, shape_layer)
+        assert False, "expected a ValueError"
+    except ValueError:
+        pass
+
+
+def test_get_area_from_shape_by_extent_without_areas(tmp_path):
+    fn = str(tmp_path / "zones.geojson")
+    write_geojson(fn, [(106.0, 10.0, 106.1, 10.1)])
+    dataset = make_dataset(fn)
+    dataset["shapeLayers"][0]["computeAreas"] = False
+    datasets = Datasets._DatasetRegistry({"test": dataset})
+
+    data_loader = DataLoaderCustom(str(tmp_path / "unused.tif"), datasets["test"]["shape_layers"], 0)
+    extent = {"xmin": 106.04, "xmax": 106.06, "ymin": 10.04, "ymax": 10.06, "crs": "epsg:4326"}
+    try:
+        data_loader.get_area_from_shape_by_extent(extent, "Zones")
+        assert False, "expected a ValueError"
+    except ValueError:
+        pass
+
+
+def test_registry_checks_files_when_a_dataset_is_loaded(tmp_path):
+    added_fn = str(tmp_path / "added.geojson")
+    removed_fn = str(tmp_path / "removed.geojson")
+    write_geojson(removed_fn, [(106.0, 10.0, 106.1, 10.1)])
+    datasets = Datasets._DatasetRegistry({
+        "added": make_dataset(added_fn),
+        "removed": make_dataset(removed_fn),
+    })
+
+    # Files can change between when the registry is created and when a dataset is first used
+    write_geojson(added_fn, [(106.0, 10.0, 106.1, 10.1)])
+    os.remove(removed_fn)
+
+    assert "added" in datasets
+    assert "removed" not in datasets
+
+
+def test_registry_handles_unreadable_shape_files(tmp_path):
+    fn = str(tmp_path / "zones.geojson")
+    with open(fn, "w") as f:
+        f.write("this is not geojson")
+    datasets = Datasets._DatasetRegistry({"test": make_dataset(fn)})
+
+    assert "test" not in datasets
+    assert "test" not in datasets
+
+
+def test_registry_load_all(tmp_path):
+    fns = [str(tmp_path / ("zones_%d.geojson" % (i))) for i in range(2)]
+    for fn in fns:
+        write_geojson(fn, [(106.0, 10.0, 106.1, 10.1)])
+    datasets = Datasets._DatasetRegistry({
+        "a": make_dataset(fns[0]),
+        "b": make_dataset(fns[1]),
+        "missing": make_dataset(str(tmp_path / "missing.geojson")),
+    })
+
+    datasets.load_all()
+    assert all(os.path.exists(fn + ".cache.pkl") for fn in fns)
+    assert "a" in datasets and "b" in datasets
+    assert "missing" not in datasets
+
+
+def test_get_utm_epsg_from_lonlat():
+    known_zones = [
+        # (lon, lat, epsg)
+        (106.7, 10.7, 32648),   # Ho Chi Minh City
+        (-76.6, 38.9, 32618),   # Maryland
+        (-58.4, -34.6, 32721),  # Buenos Aires
+        (0.0, 0.0, 32731),      # the equator is in the southern hemisphere
+        (0.0, 0.1, 32631),
+        (-180.0, 10.0, 32601),
+        (179.9, 10.0, 32660),
+        (180.0, 10.0, 32601),   # same meridian as -180
+        (5.0, 60.0, 32632),     # Norway exception
+        (2.9, 60.0, 32631),
+        (5.0, 64.0, 32631),
+        (5.0, 55.9, 32631),
+        (8.9, 78.0, 32631),     # Svalbard exception
+        (10.0, 78.0, 32633),
+        (25.0, 78.0, 32635),
+        (40.0, 78.0, 32637),
+        (45.0, 78.0, 32638),
+        (10.0, 84.0, 32633),    # the Svalbard exception includes lat=84
+        (10.0, 84.5, 32632),
+        (10.0, 72.0, 32633),
+        (10.0, 71.9, 32632),
+    ]
+    for lon, lat, epsg in known_zones:
+        assert Datasets.get_utm_epsg_from_lonlat(lon, lat) == epsg, (lon, lat)
+
+
+def test_get_area_from_geometry():
+    geom = {"type": "Polygon", "coordinates": [[[106.0, 10.0], [106.1, 10.0], [106.1, 10.1], [106.0, 10.1], [106.0, 10.0]]]}
+    area = Datasets.get_area_from_geometry(geom)
+    assert abs(area - 121.7) < 1.0 # a 0.1 x 0.1 degree box at 10 degrees north is ~121.7 km^2
+
+
+def test_zone_shape_layers_are_not_simplified(tmp_path):
+    fn = str(tmp_path / "zones.geojson")
+    with open(fn, "w") as f:
+        json.dump({"type": "FeatureCollection", "features": [{
+            "type": "Feature",
+            "properties": {"id": 0},
+            "geometry": {"type": "Polygon", "coordinates": [[[106.0, 10.0], [106.05, 10.00001], [106.1, 10.0], [106.1, 10.1], [106.0, 10.1], [106.0, 10.0]]]}
+        }]}, f)
+    zones_dataset = make_dataset(fn)
+    zones_dataset["shapeLayers"][0]["simplifyTolerance"] = 0.001
+    outlines_dataset = make_dataset(fn)
+    outlines_dataset["shapeLayers"][0]["simplifyTolerance"] = 0.001
+    del outlines_dataset["shapeLayers"][0]["zoneNameKey"]
+    datasets = Datasets._DatasetRegistry({"zones": zones_dataset, "outlines": outlines_dataset})
+
+    assert len(datasets["zones"]["shape_layers"]["Zones"]["geoms"][0].exterior.coords) == 6
+    assert len(datasets["outlines"]["shape_layers"]["Zones"]["geoms"][0].exterior.coords) == 5
+
+
+def test_registry_load_all_with_an_unreadable_shape_file(tmp_path):
+    fns = [str(tmp_path / ("zones_%d.geojson" % (i))) for i in range(2)]
+    for fn in fns:
+        write_geojson(fn, [(106.0, 10.0, 106.1, 10.1)])
+    corrupt_fn = str(tmp_path / "corrupt.geojson")
+    with open(corrupt_fn, "w") as f:
+        f.write("this is not geojson")
+    datasets = Datasets._DatasetRegistry({
+        "a": make_dataset(fns[0]),
+        "b": make_dataset(fns[1]),
+        "corrupt": make_dataset(corrupt_fn),
+    })
+
+    datasets.load_all()
+    assert "a" in datasets and "b" in datasets
+    assert "corrupt" not in datasets
+
+
+def test_broken_symlinks_are_missing_files(tmp_path):
+    fn = str(tmp_path / "zones.geojson")
+    os.symlink(str(tmp_path / "does_not_exist.geojson"), fn)
+
+    assert Datasets._get_existing_fns([fn]) == set()
+    assert "test" not in Datasets._DatasetRegistry({"test": make_dataset(fn)})
@@ -47,6 +47,22 @@ def extent_to_transformed_geom(extent, dest_crs):
     return fiona.transform.transform_geom(src_crs, dest_crs, geom)
 
 
+def get_shape_by_extent_from_shape_layer(extent, shape_layer):
+    ''' Returns the index and geometry of the first shape in `shape_layer` (a loaded shape layer from Datasets.py) that contains the centroid of `extent`.
+    '''
+    transformed_geom = extent_to_transformed_geom(extent, shape_layer["crs"])
+    centroid = shapely.geometry.shape(transformed_geom).centroid
+    geoms = shape_layer["geoms"]
+
+    # The tree gives us the shapes whose bounding boxes contain the centroid, then we check those against the (prepared) shapes themselves
+    indices = np.sort(shape_layer["tree"].query(centroid))
+    indices = indices[shapely.contains(geoms[indices], centroid)]
+    if len(indices) == 0:
+        raise ValueError("No shape contains the centroid")
+    i = int(indices[0]) # if shapes overlap, return the first one that contains the centroid
+    return i, geoms[i]
+
+
 def warp_data_to_3857(src_img, src_crs, src_transform, src_bounds):
     ''' Assume that src_img is (height, width, channels)
     '''
@@ -155,16 +171,13 @@ class DataLoaderCustom(DataLoader):
 
     def get_area_from_shape_by_extent(self, extent, shape_layer):
         i, shape = self.get_shape_by_extent(extent, shape_layer)
-        return self.shapes[shape_layer]["areas"][i]
+        area = self.shapes[shape_layer]["areas"][i]
+        if np.isnan(area): # see `_get_compute_areas` in Datasets.py
+            raise ValueError("Areas were not computed for the '%s' shape layer, set \"computeAreas\" to true in its definition" % (shape_layer))
+        return area
 
     def get_shape_by_extent(self, extent, shape_layer):
-        transformed_geom = extent_to_transformed_geom(extent, self.shapes[shape_layer]["crs"])
-        transformed_shape = shapely.geometry.shape(transformed_geom)
-        mask_geom = None
-        for i, shape in enumerate(self.shapes[shape_layer]["geoms"]):
-            if shape.contains(transformed_shape.centroid):
-                return i, shape
-        raise ValueError("No shape contains the centroid")
+        return get_shape_by_extent_from_shape_layer(extent, self.shapes[shape_layer])
 
     def get_data_from_shape(self, shape):
         '''Note: We assume that the shape is a geojson geometry in EPSG:4326'''
@@ -268,13 +281,7 @@ class DataLoaderUSALayer(DataLoader):
         return fn
     
     def get_shape_by_extent(self, extent, shape_layer):
-        transformed_geom = extent_to_transformed_geom(extent, shapes_crs)
-        transformed_shape = shapely.geometry.shape(transformed_geom)
-        mask_geom = None
-        for i, shape in enumerate(shapes):
-            if shape.contains(transformed_shape.centroid):
-                return i, shape
-        raise ValueError("No shape contains the centroid")
+        return get_shape_by_extent_from_shape_layer(extent, self.shapes[shape_layer])
 
     def get_data_from_extent(self, extent, geo_data_type=USALayerGeoDataTypes.NAIP):
         naip_fn = NAIPTileIndex.lookup(extent)
@@ -1,11 +1,19 @@
 import os
+import math
 import json
+import functools
+import pickle
+import tempfile
+import threading
+import concurrent.futures
 
-import utm
-import fiona
-import fiona.transform
+import numpy as np
+
+import pyogrio.raw
 import shapely
 import shapely.geometry
+import shapely.strtree
+import pyproj
 
 import logging
 LOGGER = logging.getLogger("server")
@@ -13,6 +21,45 @@ LOGGER = logging.getLogger("server")
 from . import ROOT_DIR
 from .DataLoader import DataLoaderCustom, DataLoaderUSALayer, DataLoaderBasemap
 
+SHAPE_CACHE_VERSION = 3 # bump this whenever the format of the shape layer cache files changes
+
+def _get_utm_zone_number(lon, lat):
+    ''' Same as `utm.latlon_to_zone_number`, including the Norway and Svalbard exceptions.
+    '''
+    if 56 <= lat < 64 and 3 <= lon < 12:
+        return 32
+    if 72 <= lat <= 84 and lon >= 0:
+        if lon < 9:
+            return 31
+        elif lon < 21:
+            return 33
+        elif lon < 33:
+            return 35
+        elif lon < 42:
+            return 37
+    return int((lon + 180) / 6) % 60 + 1
+
+@functools.lru_cache(maxsize=128)
+def _get_utm_epsg_from_bucket(lon_bucket, lat_bucket, north):
+    ''' All UTM zone boundaries (including the Norway/Svalbard exceptions) fall on whole degrees, so every point in a 1x1 degree bucket is in the same zone.
+    '''
+    zone_number = _get_utm_zone_number(lon_bucket + 0.5, lat_bucket + 0.5)
+    return (32600 if north else 32700) + zone_number # WGS84 / UTM zone EPSG codes, e.g. 32618 is "WGS 84 / UTM zone 18N"
+
+def get_utm_epsg_from_lonlat(lon, lat):
+    lat_bucket = int(math.floor(lat))
+    if lat == 84: # the Svalbard exception is the only zone boundary that includes its upper edge, i.e. it is 72 <= lat <= 84
+        lat_bucket = 83
+    return _get_utm_epsg_from_bucket(int(math.floor(lon)), lat_bucket, lat > 0)
+
+@functools.lru_cache(maxsize=128)
+def _get_transformer(src_crs, dest_crs):
+    return pyproj.Transformer.from_crs(src_crs, dest_crs, always_xy=True)
+
+def _transform_shapes(shapes, transformer):
+    ''' Transforms the coordinates of all of the shapely geometries in `shapes` (a single geometry or a numpy array of them) in one vectorized call.
+    '''
+    return shapely.transform(shapes, lambda coords: np.stack(transformer.transform(coords[:,0], coords[:,1]), axis=1))
 
 def get_area_from_geometry(geom, src_crs="epsg:4326"):
     if geom["type"] == "Polygon":
@@ -22,56 +69,204 @@ def get_area_from_geometry(geom, src_crs="epsg:4326"):
     else:
         raise ValueError("Polygons and MultiPolygons only")
 
-    zone_number = utm.latlon_to_zone_number(lat, lon)
-    hemisphere = "+north" if lat > 0 else "+south"
-    dest_crs = "+proj=utm +zone=%d %s +datum=WGS84 +units=m +no_defs" % (zone_number, hemisphere)
-    projected_geom = fiona.transform.transform_geom(src_crs, dest_crs, geom)
-    area = shapely.geometry.shape(projected_geom).area / 1000000.0 # we calculate the area in square meters then convert to square kilometers
+    transformer = _get_transformer(src_crs, get_utm_epsg_from_lonlat(lon, lat))
+    projected_shape = _transform_shapes(shapely.geometry.shape(geom), transformer)
+    area = projected_shape.area / 1000000.0 # we calculate the area in square meters then convert to square kilometers
     return area
 
-def _load_geojson_as_list(fn):
-    ''' Takes a geojson file as input and outputs a list of shapely `shape` objects in that file and their corresponding areas in km^2.
+def get_areas_from_shapes(shapes, src_crs="epsg:4326"):
+    ''' Takes a numpy array of shapely geometries and returns a numpy array of their areas in km^2.
+
+    All of the shapes are projected at once (with a single `pyproj.Transformer`) into a Lambert azimuthal equal-area projection that is centered on
+    the bounds of the shapes, then measured with `shapely.area`.
+    '''
+    if len(shapes) == 0:
+        return np.zeros(0, dtype=np.float64)
+
+    minx, miny, maxx, maxy = shapely.total_bounds(shapes)
+    dest_crs = "+proj=laea +lat_0=%f +lon_0=%f +datum=WGS84 +units=m +no_defs" % ((miny + maxy) / 2.0, (minx + maxx) / 2.0)
+    transformer = pyproj.Transformer.from_crs(src_crs, dest_crs, always_xy=True)
+
+    projected_shapes = _transform_shapes(shapes, transformer)
+
+    areas = np.empty(len(shapes), dtype=np.float64)
+    shapely.area(projected_shapes, out=areas)
+    areas /= 1000000.0 # we calculate the area in square meters then convert to square kilometers
+    return areas
+
+def _write_shape_cache(cache_fn, cache):
+    ''' Writes `cache` to a temporary file next to `cache_fn` then renames it over `cache_fn`, so that concurrent readers (other processes, or other
+    datasets that share the same shape file) never see a partially written cache.
+    '''
+    tmp_fn = None
+    try:
+        with tempfile.NamedTemporaryFile("wb", dir=os.path.dirname(cache_fn) or ".", prefix=".", suffix=".tmp", delete=False) as f:
+            tmp_fn = f.name
+            pickle.dump(cache, f)
+        os.replace(tmp_fn, cache_fn)
+    except OSError as e:
+        LOGGER.warning("Could not write the shape cache '%s': %s" % (cache_fn, str(e)))
+        if tmp_fn is not None and os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+
+def _load_geojson_as_list(fn, compute_areas=True):
+    ''' Takes a geojson file as input and outputs a numpy array of the shapely geometries in that file and a numpy array of their corresponding areas
+    in km^2 (see `get_areas_from_shapes`). This assumes that the shapes are in lat/lon coordinates, which is always the case for geojson.
+
+    If `compute_areas` is False then we skip the area calculation and all of the returned areas are NaN.
 
-    We calculate area here by re-projecting the shape into its local UTM zone, converting it to a shapely `shape`, then using the `.area` property.
+    The file is read with `pyogrio`, which returns all of the geometries as WKB in a single call (we skip reading the attribute fields entirely). The
+    returned CRS is a string, e.g. "EPSG:4326".
+
+    The results are cached next to the input file (as `fn + ".cache.pkl"`) with the geometries stored as WKB. The cache is reused as long as it is
+    at least as new as the input file, so that we only pay the cost of parsing the geojson once.
     '''
-    shapes = []
-    areas = []
-    crs = None
-    with fiona.open(fn) as f:
-        src_crs = f.crs
-        for row in f:
-            geom = row["geometry"]
-            
-            area = get_area_from_geometry(geom, src_crs)
-            areas.append(area)
-
-            shape = shapely.geometry.shape(geom)
-            shapes.append(shape)
+    shapes_wkb, areas, src_crs = None, None, None
+
+    cache_fn = fn + ".cache.pkl"
+    if os.path.exists(cache_fn) and os.path.getmtime(cache_fn) >= os.path.getmtime(fn):
+        try:
+            with open(cache_fn, "rb") as f:
+                cache_version, cached_shapes_wkb, cached_areas, cached_src_crs = pickle.load(f)
+            if cache_version == SHAPE_CACHE_VERSION:
+                shapes_wkb, areas, src_crs = cached_shapes_wkb, cached_areas, cached_src_crs
+        except Exception as e:
+            LOGGER.warning("Could not read the shape cache '%s', re-loading from '%s': %s" % (cache_fn, fn, str(e)))
+
+    cache_is_stale = False
+    if shapes_wkb is None:
+        meta, _, shapes_wkb, _ = pyogrio.raw.read(fn, columns=[])
+        src_crs = meta["crs"]
+        cache_is_stale = True
+    shapes = shapely.from_wkb(shapes_wkb)
+
+    if compute_areas and areas is None:
+        areas = get_areas_from_shapes(shapes, src_crs)
+        cache_is_stale = True
+
+    if cache_is_stale:
+        _write_shape_cache(cache_fn, (SHAPE_CACHE_VERSION, shapes_wkb, areas, src_crs)) # `areas` is None in the cache if they haven't been computed
+
+    if areas is None:
+        areas = np.full(len(shapes), np.nan, dtype=np.float64)
+
     return shapes, areas, src_crs
 
 
-def _load_dataset(dataset):
-    # Step 1: load the shape layers
-    shape_layers = {}
+def _load_geojson_files(fns):
+    ''' Runs `_load_geojson_as_list` on each of the files in `fns` in a pool of processes and returns a dictionary mapping fn to the results.
+
+    `fns` is a dictionary mapping fn to whether or not we need to compute the areas of the shapes in that file.
+
+    Files that fail to load are logged and left out of the results (so the other files are still returned), the datasets that use them will hit the
+    same error when they try to load the file themselves.
+    '''
+    if len(fns) == 0:
+        return {}
+    elif len(fns) == 1: # not worth starting a pool for
+        fn, compute_areas = next(iter(fns.items()))
+        try:
+            return {fn: _load_geojson_as_list(fn, compute_areas)}
+        except Exception as e:
+            LOGGER.warning("Could not load the shape file '%s': %s" % (fn, str(e)))
+            return {}
+
+    loaded_geojson_files = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(len(fns), os.cpu_count() or 1)) as executor:
+        futures = {fn: executor.submit(_load_geojson_as_list, fn, compute_areas) for fn, compute_areas in fns.items()}
+        for fn, future in futures.items():
+            try:
+                loaded_geojson_files[fn] = future.result()
+            except Exception as e:
+                LOGGER.warning("Could not load the shape file '%s': %s" % (fn, str(e)))
+    return loaded_geojson_files
+
+def _get_compute_areas(shape_layer):
+    ''' By default we only compute areas for shape layers that are bound to zone names in the UI, this can be overridden with "computeAreas".
+    '''
+    return shape_layer.get("computeAreas", shape_layer.get("zoneNameKey") is not None)
+
+def _get_shape_fns(dataset):
+    ''' Returns a dictionary mapping each of the shape files in `dataset` to whether or not we need to compute the areas of its shapes.
+    '''
+    shape_fns = {}
     if dataset["shapeLayers"] is not None:
         for shape_layer in dataset["shapeLayers"]:
             fn = shape_layer["shapesFn"]
-            if os.path.exists(fn):
-                shapes, areas, crs = _load_geojson_as_list(fn)
-                
-                shape_layer["geoms"] = shapes
-                shape_layer["areas"] = areas
-                shape_layer["crs"] = crs["init"] # TODO: will this break with fiona version; I think `.crs` will turn into a PyProj object
-                shape_layers[shape_layer["name"]] = shape_layer
-            else:
-                return False # TODO: maybe we should make these errors more descriptive (explain why we can't load a dataset)
+            shape_fns[fn] = shape_fns.get(fn, False) or _get_compute_areas(shape_layer)
+    return shape_fns
 
-    # Step 2: make sure the dataLayer exists
+
+def _get_dataset_fns(dataset):
+    ''' Returns a list of all of the local files that `dataset` needs in order to be loaded.
+    '''
+    fns = list(_get_shape_fns(dataset).keys())
     if dataset["dataLayer"]["type"] == "CUSTOM":
-        fn = dataset["dataLayer"]["path"]
-        if not os.path.exists(fn):
+        fns.append(dataset["dataLayer"]["path"])
+    return fns
+
+def _get_existing_fns(fns):
+    ''' Returns the set of (normalized) paths in `fns` that exist. This lists each distinct parent directory once with `os.scandir` instead of calling
+    `os.path.exists` on every file, which saves a lot of syscalls on network filesystems when checking the files of all of the datasets at once (see
+    `_DatasetRegistry.load_all`). For a single dataset listing whole directories costs more than it saves, so `_load_dataset` uses `os.path.exists`.
+    '''
+    fns = set(os.path.normpath(fn) for fn in fns)
+    existing_fns = set()
+    for dirname in set(os.path.dirname(fn) for fn in fns):
+        try:
+            with os.scandir(dirname if dirname != "" else ".") as entries:
+                for entry in entries:
+                    if entry.is_file() or entry.is_dir(): # these follow symlinks, so like `os.path.exists` we skip broken ones
+                        existing_fns.add(os.path.join(dirname, entry.name))
+        except OSError:
+            pass
+    return fns & existing_fns
+
+
+def _load_dataset(dataset, loaded_geojson_files=None, existing_fns=None):
+    ''' `loaded_geojson_files` is an optional dictionary of already loaded shape files (see `_load_geojson_files`), shape files that are not in it are
+    loaded here, in this process. We don't start a process pool here as this is called from request threads, where forking is not safe.
+
+    `existing_fns` is an optional set of the files that are known to exist (see `_get_existing_fns`), by default we check the files of `dataset` with
+    `os.path.exists`.
+    '''
+    # Step 1: make sure all of the files exist before loading anything
+    for fn in _get_dataset_fns(dataset):
+        if existing_fns is not None:
+            fn_exists = os.path.normpath(fn) in existing_fns
+        else:
+            fn_exists = os.path.exists(fn)
+        if not fn_exists:
             return False # TODO: maybe we should make these errors more descriptive (explain why we can't load a dataset)
 
+    # Step 2: load the shape layers
+    if loaded_geojson_files is None:
+        loaded_geojson_files = {}
+
+    shape_layers = {}
+    if dataset["shapeLayers"] is not None:
+        for shape_layer in dataset["shapeLayers"]:
+            fn = shape_layer["shapesFn"]
+            if fn in loaded_geojson_files:
+                shapes, areas, crs = loaded_geojson_files[fn]
+            else:
+                shapes, areas, crs = _load_geojson_as_list(fn, _get_compute_areas(shape_layer))
+
+            if shape_layer.get("simplifyTolerance") is not None: # in the units of the shape layer's CRS, i.e. degrees for geojson
+                if shape_layer.get("zoneNameKey") is not None:
+                    # Simplifying each zone on its own moves the borders that it shares with its neighbors, so a point could end up in no zone or in two,
+                    # and the looked up shape would no longer match its area (which is computed from the original shape)
+                    LOGGER.warning("Not simplifying the '%s' shape layer because it has a \"zoneNameKey\"" % (shape_layer["name"]))
+                else:
+                    shapes = shapely.simplify(shapes, shape_layer["simplifyTolerance"], preserve_topology=True)
+
+            shapely.prepare(shapes) # in place, makes the point-in-polygon checks in `DataLoaderCustom.get_shape_by_extent` much faster for complex shapes
+            shape_layer["geoms"] = shapes
+            shape_layer["areas"] = areas
+            shape_layer["crs"] = crs
+            shape_layer["tree"] = shapely.strtree.STRtree(shapes) # spatial index over "geoms", see `DataLoaderCustom.get_shape_by_extent`
+            shape_layers[shape_layer["name"]] = shape_layer
+
     # Step 3: setup the appropriate DatasetLoader
     if dataset["dataLayer"]["type"] == "CUSTOM":
         data_loader = DataLoaderCustom(dataset["dataLayer"]["path"], shape_layers, dataset["dataLayer"]["padding"])
@@ -87,37 +282,101 @@ def _load_dataset(dataset):
         "shape_layers": shape_layers,
     }
 
-def load_datasets():
-    datasets = dict()
+class _DatasetRegistry():
+    ''' Dictionary-like collection of datasets that only loads a dataset (its shape layers and DataLoader) the first time that it is accessed.
+
+    A dataset whose files are missing is treated as if it does not exist, i.e. `dataset_key in datasets` is False.
+
+    Each dataset has its own lock, so loading one dataset doesn't block requests for datasets that are already loaded.
+    '''
+
+    def __init__(self, dataset_definitions):
+        self._definitions = dataset_definitions
+        self._cache = dict()
+        self._locks = {key: threading.Lock() for key in dataset_definitions}
+
+    def _load_one(self, dataset_key, loaded_geojson_files=None, existing_fns=None):
+        ''' Returns the loaded dataset, or False if it can't be loaded. The files of the dataset are checked now (not when the registry is created),
+        as this can happen long after startup.
+        '''
+        try:
+            dataset_object = _load_dataset(self._definitions[dataset_key], loaded_geojson_files, existing_fns)
+        except Exception as e: # e.g. a shape file that was removed after we checked that it exists, or that can't be parsed
+            LOGGER.error("Could not load the following dataset: '%s': %s" % (dataset_key, str(e)))
+            return False
 
-    dataset_json = json.load(open(os.path.join(ROOT_DIR, "datasets.json"),"r"))
-    for key, dataset in dataset_json.items():
-        dataset_object = _load_dataset(dataset)
-        
         if dataset_object is False:
-            LOGGER.warning("Files are missing, we will not be able to serve the following dataset: '%s'" % (key)) 
-        else:
-            datasets[key] = dataset_object
+            LOGGER.warning("Files are missing, we will not be able to serve the following dataset: '%s'" % (dataset_key))
+        return dataset_object
+
+    def _get(self, dataset_key):
+        if dataset_key in self._cache: # already loaded (or failed to load), no need to take the lock
+            return self._cache[dataset_key]
+        with self._locks[dataset_key]:
+            if dataset_key not in self._cache:
+                self._cache[dataset_key] = self._load_one(dataset_key)
+            return self._cache[dataset_key]
+
+    def __contains__(self, dataset_key):
+        return dataset_key in self._definitions and self._get(dataset_key) is not False
+
+    def __getitem__(self, dataset_key):
+        if dataset_key not in self:
+            raise KeyError(dataset_key)
+        return self._cache[dataset_key]
+
+    def keys(self):
+        return self._definitions.keys()
+
+    def load_all(self):
+        ''' Loads all of the datasets that haven't been loaded yet, with the shape files from every dataset loaded in a single process pool.
+
+        This restores eager loading, i.e. it moves the cost of loading the datasets from the first requests to startup. It must be called before any
+        other threads are started, as forking a process that has other threads running can deadlock.
+        '''
+        dataset_keys = [key for key in self._definitions if key not in self._cache]
+
+        all_fns = []
+        for key in dataset_keys:
+            all_fns.extend(_get_dataset_fns(self._definitions[key]))
+        existing_fns = _get_existing_fns(all_fns)
+
+        shape_fns = {}
+        for key in dataset_keys:
+            dataset = self._definitions[key]
+            if all(os.path.normpath(fn) in existing_fns for fn in _get_dataset_fns(dataset)):
+                for fn, compute_areas in _get_shape_fns(dataset).items():
+                    shape_fns[fn] = shape_fns.get(fn, False) or compute_areas
+        loaded_geojson_files = _load_geojson_files(shape_fns)
+
+        for key in dataset_keys:
+            with self._locks[key]:
+                if key not in self._cache:
+                    self._cache[key] = self._load_one(key, loaded_geojson_files, existing_fns)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_dataset_definitions():
+    ''' Parses datasets.json and datasets.mine.json (once) and returns a dictionary of all of the dataset definitions. Keys in datasets.mine.json that
+    conflict with datasets.json are skipped.
+    '''
+    dataset_definitions = json.load(open(os.path.join(ROOT_DIR, "datasets.json"),"r"))
 
     if os.path.exists(os.path.join(ROOT_DIR, "datasets.mine.json")):
         dataset_json = json.load(open(os.path.join(ROOT_DIR, "datasets.mine.json"),"r"))
         for key, dataset in dataset_json.items():
 
-            if key not in datasets:
-                dataset_object = _load_dataset(dataset)
-                
-                if dataset_object is False:
-                    LOGGER.warning("Files are missing, we will not be able to serve the following dataset: '%s'" % (key)) 
-                else:
-                    datasets[key] = dataset_object
+            if key not in dataset_definitions:
+                dataset_definitions[key] = dataset
             else:
                 LOGGER.warning("There is a conflicting dataset key in datasets.mine.json, skipping.")
 
-    return datasets
+    return dataset_definitions
 
-def is_valid_dataset(dataset_key):
-
-    dataset_json = json.load(open(os.path.join(ROOT_DIR, "datasets.json"),"r"))
-    dataset_mine_json = json.load(open(os.path.join(ROOT_DIR, "datasets.mine.json"),"r"))
+def load_datasets():
+    ''' Returns a `_DatasetRegistry` with the datasets defined in datasets.json and datasets.mine.json. The datasets themselves are loaded lazily.
+    '''
+    return _DatasetRegistry(_load_dataset_definitions())
 
-    return (dataset_key in dataset_json) or (dataset_key in dataset_mine_json)
\ No newline at end of file
+def is_valid_dataset(dataset_key):
+    return dataset_key in _load_dataset_definitions()